@@ -21,7 +21,9 @@ def some_fun():
 def some_loop():
     loop_logger = logging.getLogger("loop")
     for i in range(1000000):
-        loop_logger.debug(f"Hello from loop logger: {i}")
+        # Lazy %-formatting defers the string build to the handler,
+        # so disabled levels skip it entirely.
+        loop_logger.debug("Hello from loop logger: %d", i)
 
 
 if __name__ == "__main__":
@@ -8,23 +8,27 @@
 # https://github.com/mgtek/pyetw
 #
 
+import functools
 import hashlib
 import logging
+import queue
 import struct
+import threading
 from uuid import UUID
 from ctypes import (
     WINFUNCTYPE,
     POINTER,
     Structure,
-    c_bool,
     c_byte,
     c_int,
+    c_ubyte,
     c_ushort,
     c_ulong,
     c_ulonglong,
     c_void_p,
     windll,
     addressof,
+    cast,
 )
 
 # pylint: disable=attribute-defined-outside-init
@@ -36,6 +40,67 @@ REGHANDLE = c_ulonglong
 
 ERROR_SUCCESS = 0
 
+_INT_STRUCT = struct.Struct("=i")
+
+# Maps logging levels to ETW levels (TRACE_LEVEL_CRITICAL..TRACE_LEVEL_VERBOSE).
+_LEVEL_MAP = {
+    logging.CRITICAL: 1,
+    logging.ERROR: 2,
+    logging.WARNING: 3,
+    logging.INFO: 4,
+    logging.DEBUG: 5,
+}
+
+_PYETW_NAMESPACE = UUID("482c2db2-c390-47c8-87f8-1a15bfc130fb")
+
+
+@functools.lru_cache(maxsize=1024)
+def _get_uuid_from_provider_name(name: str) -> UUID:
+    sha1 = hashlib.sha1()
+    sha1.update(_PYETW_NAMESPACE.bytes)
+    sha1.update(name.upper().encode("utf_16_be"))
+    guid = bytearray(sha1.digest()[:16])
+    guid[7] = (guid[7] & 0x0F) | 0x50
+    return UUID(bytes_le=bytes(guid))
+
+
+_ACTIVITY_ID_BYTES = _get_uuid_from_provider_name("pyetw").bytes_le
+
+
+def _encode_field(field_name: str, in_type: int, out_type: int) -> bytes:
+    return field_name.encode("utf_8") + b"\x00" + bytes((0x80 | in_type, out_type))
+
+
+# The fixed field schema of the events emitted by LoggerHandler as
+# (field name, TDH in type, TDH out type), preserialized at import so
+# emit() only appends the per-record values.
+_LOG_SCHEMA = (
+    ("module", 2, 35),
+    ("funcName", 2, 35),
+    ("pathname", 2, 35),
+    ("filename", 2, 35),
+    ("lineno", 7, 0),
+    ("levelname", 2, 35),
+    ("msg", 2, 35),
+)
+
+_LOG_FIELDS_BLOB = b"".join(_encode_field(*field) for field in _LOG_SCHEMA)
+
+
+@functools.lru_cache(maxsize=256)
+def _build_metadata(name_utf8: bytes, fields: bytes):
+    metadata = bytearray(struct.pack("=HB", 2 + 1 + len(name_utf8) + len(fields), 0))
+    metadata.extend(name_utf8)
+    metadata.extend(fields)
+    # The ctypes buffer shares storage with the bytearray and keeps it alive.
+    return (c_byte * len(metadata)).from_buffer(metadata)
+
+
+# The metadata of the fixed log-record schema, built once at import.
+_LOG_METADATA = _build_metadata(b"pyetw\x00", _LOG_FIELDS_BLOB)
+_LOG_METADATA_PTR = addressof(_LOG_METADATA)
+_LOG_METADATA_SIZE = len(_LOG_METADATA)
+
 
 def _etw_function(name: str, *args):
     def errcheck(result, _, args):
@@ -53,13 +118,29 @@ def _etw_function(name: str, *args):
     return function
 
 
-def _etw_function_bool(name: str, *args):
+def _etw_function_nocheck(name: str, *args):
     argtypes = (arg[1] for arg in args)
     paramflags = tuple((arg[0], arg[2]) for arg in args)
-    prototype = WINFUNCTYPE(c_bool, *argtypes)
+    prototype = WINFUNCTYPE(c_ulong, *argtypes)
     return prototype((name, windll.advapi32), paramflags)
 
 
+# PENABLECALLBACK, see evntprov.h
+_ENABLE_CALLBACK = WINFUNCTYPE(
+    None,
+    c_void_p,  # SourceId
+    c_ulong,  # IsEnabled
+    c_ubyte,  # Level
+    c_ulonglong,  # MatchAnyKeyword
+    c_ulonglong,  # MatchAllKeyword
+    c_void_p,  # FilterData
+    c_void_p,  # CallbackContext
+)
+
+EVENT_CONTROL_CODE_DISABLE_PROVIDER = 0
+EVENT_CONTROL_CODE_ENABLE_PROVIDER = 1
+
+
 # pylint: disable-next=too-few-public-methods
 class _EventDescriptor(Structure):
     _fields_ = [
@@ -81,12 +162,32 @@ class _EventDataDescriptor(Structure):
 class Event:
     """Represents an ETW tracelogging event."""
 
-    def __init__(self, name: str, level: int = 0, keyword: int = 0):
+    def __init__(self, name: str = "", level: int = 0, keyword: int = 0):
+        self._name = name
+        self._level = level
+        self._keyword = keyword
+        self._fields = bytearray()
+        self._data = bytearray()
+
+    def reset(self, name: str, level: int = 0, keyword: int = 0) -> None:
+        """
+        Reinitializes the event for reuse, clearing the field and data
+        buffers without reallocating them.
+
+        Parameters
+        ----------
+        name : str
+            The name of the event.
+        level : int
+            The event level.
+        keyword : int
+            The event keyword.
+        """
         self._name = name
         self._level = level
         self._keyword = keyword
-        self._fields = b""
-        self._data = b""
+        self._fields.clear()
+        self._data.clear()
 
     @property
     def name(self) -> str:
@@ -105,17 +206,22 @@ class Event:
 
     @property
     def metadata(self):
-        """Gets the encoded TDH event metadata."""
+        """Gets the encoded TDH event metadata.
+
+        The returned buffer is cached and shared between all events with
+        the same name and schema; it must be treated as read-only.
+        """
         name_utf8 = self._name.encode("utf_8") + b"\x00"
-        metadata = struct.pack("=HB", 2 + 1 + len(name_utf8) + len(self._fields), 0)
-        metadata += struct.pack(f"={len(name_utf8)}s", name_utf8)
-        metadata += self._fields
-        return (c_byte * len(metadata)).from_buffer_copy(metadata)
+        return _build_metadata(name_utf8, bytes(self._fields))
 
     @property
     def data(self):
-        """Gets the encoded TDH event data."""
-        return (c_byte * len(self._data)).from_buffer_copy(self._data)
+        """Gets the encoded TDH event data.
+
+        The returned buffer shares storage with the event; it must be
+        released before the event is reset or modified again.
+        """
+        return (c_byte * len(self._data)).from_buffer(self._data)
 
     def add_int(self, field_name: str, value: int):
         """
@@ -129,7 +235,7 @@ class Event:
             The value of the field.
         """
         self._add_field(field_name, 7, 0)  # TDH_INTYPE_INT32/TDH_OUTTYPE_NULL
-        self._data += struct.pack("=i", value)
+        self._data.extend(_INT_STRUCT.pack(value))
 
     def add_str(self, field_name: str, value: str):
         """
@@ -143,13 +249,14 @@ class Event:
             The value of the field.
         """
         self._add_field(field_name, 2, 35)  # TDH_INTYPE_ANSISTRING/TDH_OUTTYPE_UTF8
-        self._data += value.encode("utf_8") + b"\x00"
+        self._data.extend(value.encode("utf_8"))
+        self._data.append(0)
 
     def _add_field(self, field_name: str, in_type: int, out_type: int):
-        field_name_utf8 = field_name.encode("utf_8") + b"\x00"
-        self._fields += struct.pack(
-            f"={len(field_name_utf8)}sBB", field_name_utf8, 0x80 | in_type, out_type
-        )
+        self._fields.extend(field_name.encode("utf_8"))
+        self._fields.append(0)
+        self._fields.append(0x80 | in_type)
+        self._fields.append(out_type)
 
 
 class EventProvider:
@@ -176,7 +283,8 @@ class EventProvider:
         (_IN, c_ulong, "InformationLength"),
     )
 
-    _EventWriteTransfer = _etw_function(
+    # No errcheck on the hot path; _write_raw checks the result directly.
+    _EventWriteTransfer = _etw_function_nocheck(
         "EventWriteTransfer",
         (_IN, REGHANDLE, "RegHandle"),
         (_IN, POINTER(_EventDescriptor), "EventDescriptor"),
@@ -186,27 +294,33 @@ class EventProvider:
         (_IN, c_void_p, "UserData"),
     )
 
-    _EventProviderEnabled = _etw_function_bool(
-        "EventProviderEnabled",
-        (_IN, REGHANDLE, "RegHandle"),
-        (_IN, c_byte, "Level"),
-        (_IN, c_ulonglong, "Keyword"),
-    )
-
     def __init__(self, name: str, register_provider=True):
         """
         :param name: The event provider name.
         :param register_provider: Set to false to register the provider manually.
         """
         self._name = name
-        self._id = self._get_uuid_from_provider_name(name)
-        self._activity_id = self._get_uuid_from_provider_name("pyetw")
+        self._id = _get_uuid_from_provider_name(name)
+        self._activity_id_bytes = _ACTIVITY_ID_BYTES
         self._handle = None
+        self._is_enabled = False
+        self._max_level = 0
+        self._match_any_keyword = 0
+        self._enable_callback = _ENABLE_CALLBACK(self._on_enable_callback)
 
         name_utf8 = self._name.encode("utf_8") + b"\x00"
         traits = struct.pack(f"=H{len(name_utf8)}s", 2 + len(name_utf8), name_utf8)
         self._provider_traits = (c_byte * len(traits)).from_buffer_copy(traits)
 
+        self._write_lock = threading.Lock()
+        self._descriptor = _EventDescriptor()
+        self._data_descriptors = (_EventDataDescriptor * 3)()
+        self._data_descriptors[0].ptr = addressof(self._provider_traits)
+        self._data_descriptors[0].size = len(self._provider_traits)
+        self._data_descriptors[0].reserved = 2
+        self._data_descriptors[1].reserved = 1
+        self._data_descriptors[2].reserved = 0
+
         if register_provider:
             self.open()
 
@@ -215,7 +329,9 @@ class EventProvider:
 
     def open(self) -> None:
         """Registers the event provider with Windows."""
-        self._handle = EventProvider._EventRegister(self._id.bytes_le, None, None)
+        self._handle = EventProvider._EventRegister(
+            self._id.bytes_le, cast(self._enable_callback, c_void_p), None
+        )
 
         EventProvider._EventSetInformation(
             self._handle, 2, self._provider_traits, len(self._provider_traits)
@@ -226,6 +342,7 @@ class EventProvider:
         if not self._handle is None:
             EventProvider._EventUnregister(self._handle)
             self._handle = None
+            self._is_enabled = False
 
     @property
     def name(self) -> str:
@@ -244,7 +361,29 @@ class EventProvider:
 
     def is_enabled(self, level: int, keyword: int = 0) -> bool:
         """Returns True if the event based on the specified level and keyword should be written."""
-        return EventProvider._EventProviderEnabled(self._handle, level, keyword)
+        if not self._is_enabled:
+            return False
+        if self._max_level != 0 and level > self._max_level:
+            return False
+        return keyword == 0 or (keyword & self._match_any_keyword) != 0
+
+    # pylint: disable-next=too-many-arguments
+    def _on_enable_callback(
+        self,
+        _source_id,
+        is_enabled,
+        level,
+        match_any_keyword,
+        _match_all_keyword,
+        _filter_data,
+        _context,
+    ):
+        if is_enabled == EVENT_CONTROL_CODE_ENABLE_PROVIDER:
+            self._max_level = level
+            self._match_any_keyword = match_any_keyword
+            self._is_enabled = True
+        elif is_enabled == EVENT_CONTROL_CODE_DISABLE_PROVIDER:
+            self._is_enabled = False
 
     def write(self, event: Event) -> None:
         """Writes an event to the connected trace sessions.
@@ -257,74 +396,96 @@ class EventProvider:
         assert self.is_open
 
         event_metadata = event.metadata
-        event_data = event.data
-
-        event_descriptor = _EventDescriptor()
-        # pylint: disable-next=invalid-name
-        event_descriptor.id = 0
-        event_descriptor.version = 0
-        event_descriptor.channel = 0
-        event_descriptor.level = event.level
-        event_descriptor.opcode = 0
-        event_descriptor.task = 0
-        event_descriptor.keyword = 0
-
-        event_data_descriptors = (_EventDataDescriptor * 3)()
-        event_data_descriptors[0].ptr = addressof(self._provider_traits)
-        event_data_descriptors[0].size = len(self._provider_traits)
-        event_data_descriptors[0].reserved = 2
-        event_data_descriptors[1].ptr = addressof(event_metadata)
-        event_data_descriptors[1].size = len(event_metadata)
-        event_data_descriptors[1].reserved = 1
-        event_data_descriptors[2].ptr = addressof(event_data)
-        event_data_descriptors[2].size = len(event_data)
-        event_data_descriptors[2].reserved = 0
-
-        EventProvider._EventWriteTransfer(
-            self._handle,
-            event_descriptor,
-            self._activity_id.bytes_le,
-            None,
-            len(event_data_descriptors),
-            event_data_descriptors,
+        self._write_raw(
+            event.level, addressof(event_metadata), len(event_metadata), event.data
         )
 
-    # pylint: disable-next=no-self-argument
-    def _get_uuid_from_provider_name(self, name: str) -> UUID:
-        namespace = UUID("482c2db2-c390-47c8-87f8-1a15bfc130fb")
-        buffer = namespace.bytes + name.upper().encode("utf_16_be")
-        digest = hashlib.sha1(buffer).digest()
-        guid = bytearray(digest[:16])
-        guid[7] = (guid[7] & 0x0F) | 0x50
-        return UUID(bytes_le=bytes(guid))
+    def _write_raw(self, level, metadata_ptr, metadata_size, event_data) -> None:
+        # ETW allows concurrent writes, but the preallocated descriptors
+        # are shared per provider and must not be mutated concurrently.
+        with self._write_lock:
+            self._descriptor.level = level
+            self._data_descriptors[1].ptr = metadata_ptr
+            self._data_descriptors[1].size = metadata_size
+            self._data_descriptors[2].ptr = addressof(event_data)
+            self._data_descriptors[2].size = len(event_data)
+
+            result = EventProvider._EventWriteTransfer(
+                self._handle,
+                self._descriptor,
+                self._activity_id_bytes,
+                None,
+                len(self._data_descriptors),
+                self._data_descriptors,
+            )
+
+        if result != ERROR_SUCCESS:
+            raise OSError(f"EventWriteTransfer failed with error code {result}.")
+
+
+@functools.lru_cache(maxsize=None)
+def _get_provider(name: str) -> EventProvider:
+    return EventProvider(name)
+
+
+def _compile_log_packer():
+    # Generates a packer with one straight-line statement sequence per
+    # field, specialized for the fixed log-record schema.
+    field_names = [field[0] for field in _LOG_SCHEMA]
+    lines = [f"def _pack_log_data(data, {', '.join(field_names)}):"]
+    for field_name, in_type, _ in _LOG_SCHEMA:
+        if in_type == 7:  # TDH_INTYPE_INT32
+            lines.append(f"    data.extend(_INT_STRUCT.pack({field_name}))")
+        else:
+            lines.append(f"    data.extend({field_name}.encode('utf_8'))")
+            lines.append("    data.append(0)")
+    namespace = {"_INT_STRUCT": _INT_STRUCT}
+    # pylint: disable-next=exec-used
+    exec("\n".join(lines), namespace)
+    return namespace["_pack_log_data"]
+
+
+_pack_log_data = _compile_log_packer()
+
+
+# Bounds the write queue so a burst of records blocks the producer
+# instead of growing the queue without limit.
+_QUEUE_MAXSIZE = 10000
 
 
 class LoggerHandler(logging.Handler):
     """Represents a logging.Handler that redirects records to ETW."""
 
-    _providers: dict = {}
-
     def __init__(self):
         super().__init__()
+        self._queue: queue.Queue = queue.Queue(maxsize=_QUEUE_MAXSIZE)
+        self._thread = threading.Thread(target=self._drain, daemon=True)
+        self._thread.start()
 
     def emit(self, record):
         try:
-            provider = LoggerHandler._providers.get(record.name, None)
-            if provider is None:
-                provider = EventProvider(record.name)
-                LoggerHandler._providers[record.name] = provider
-
-            level = self._map_level(record.levelname)
-            if provider.is_enabled(level):
-                event = Event("pyetw", level)
-                event.add_str("module", record.module)
-                event.add_str("funcName", record.funcName)
-                event.add_str("pathname", record.pathname)
-                event.add_str("filename", record.filename)
-                event.add_int("lineno", record.lineno)
-                event.add_str("levelname", record.levelname)
-                event.add_str("msg", record.getMessage())
-                provider.write(event)
+            level = _LEVEL_MAP.get(record.levelno, 0)
+            provider = _get_provider(record.name)
+            if not provider.is_enabled(level):
+                return
+
+            # Skip the getMessage() call when there is nothing to format.
+            msg = record.msg
+            if record.args or not isinstance(msg, str):
+                msg = record.getMessage()
+
+            data = bytearray()
+            _pack_log_data(
+                data,
+                record.module,
+                record.funcName,
+                record.pathname,
+                record.filename,
+                record.lineno,
+                record.levelname,
+                msg,
+            )
+            self._queue.put((provider, level, data, record))
 
         except (KeyboardInterrupt, SystemExit):
             raise
@@ -332,15 +493,34 @@ class LoggerHandler(logging.Handler):
         except:
             self.handleError(record)
 
-    def _map_level(self, level):
-        if level in ("CRITICAL", "FATAL"):
-            return 1
-        if level == "ERROR":
-            return 2
-        if level in ("WARN", "WARNING"):
-            return 3
-        if level == "INFO":
-            return 4
-        if level == "DEBUG":
-            return 5
-        return 0
+    def flush(self):
+        if self._thread.is_alive():
+            flushed = threading.Event()
+            self._queue.put(flushed)
+            flushed.wait()
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        super().close()
+
+    def _drain(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            if isinstance(item, threading.Event):
+                item.set()
+                continue
+
+            provider, level, data, record = item
+            try:
+                event_data = (c_byte * len(data)).from_buffer(data)
+                # pylint: disable-next=protected-access
+                provider._write_raw(
+                    level, _LOG_METADATA_PTR, _LOG_METADATA_SIZE, event_data
+                )
+            # pylint: disable-next=bare-except
+            except:
+                self.handleError(record)